@@ -76,6 +76,14 @@
 # % description: All changes to or from this value will be assigned the same value and visualised in white. useful for e.g. cloud masking
 # %end
 
+# %option G_OPT_MEMORYMB
+# %end
+
+# %option G_OPT_M_NPROCS
+# % answer: 1
+# % description: Number of threads for the mode filter (0: all cores, <0: all cores minus nprocs)
+# %end
+
 # %flag
 # % key: f
 # % description: Filter change detection product using a mode filter of size window_size
@@ -98,59 +106,310 @@
 
 
 import atexit
-import csv
+import numba
 import numpy as np
 import os
+import sys
 import grass.script as grass
-from grass.lib.gis import GRASS_EPSILON
+from grass.script import array as garray
 
 # initialize global vars
-rm_rasters = []
+rm_files = []
+
+# approximate memory needed per cell while processing a tile
+BYTES_PER_CELL = 48
+# change values hold the category index of map 1 in the lower and the one
+# of map 2 in the upper 16 bits
+CHANGE_BITS = 16
+CHANGE_MASK = (1 << CHANGE_BITS) - 1
+NULL_CHANGE = np.iinfo(np.uint32).max
+# null value of GRASS CELL maps
+NULL_CELL = np.iinfo(np.int32).min
+
+# cache the compiled numba kernels with the addon, so that re-runs skip the
+# compilation and the scripts directory stays clean
+if os.environ.get("GRASS_ADDON_BASE") and not numba.config.CACHE_DIR:
+    numba.config.CACHE_DIR = os.path.join(
+        os.environ["GRASS_ADDON_BASE"], "etc", "r.change.stats", "__pycache__"
+    )
 
 
 def cleanup():
-    nuldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
-
-
-def reclassify(map_in, map_out, values_in, values_out):
-    reclass_string = ""
-    for idx, item in enumerate(values_in):
-        reclass_string += "%s = %s\n" % (item, values_out[idx])
-    recl = grass.feed_command("r.reclass", input=map_in, output=map_out, rules="-")
-    recl.stdin.write(reclass_string.encode())
-    recl.stdin.close()
+    for rmfile in rm_files:
+        if os.path.isfile(rmfile):
+            os.remove(rmfile)
+
+
+def feed_rules(module, rules, **kwargs):
+    """Feeds the list of rules to module via stdin"""
+    proc = grass.feed_command(module, rules="-", **kwargs)
+    proc.stdin.write(b"\n".join(rule.encode() for rule in rules))
+    proc.stdin.close()
     # feed_command does not wait until finished
-    recl.wait()
+    proc.wait()
+
+
+def temp_array(mapname=None, null=None, dtype=np.int32):
+    """Creates a temporary integer array of the current region"""
+    arr = garray.array(mapname, null=null, dtype=dtype)
+    rm_files.append(arr.filename)
+    return arr
+
+
+def generate_tiling_grid(rows, tile_rows, overlap=0):
+    """Splits rows into tiles of tile_rows rows
+
+    Returns a list of (outer, inner) slices per tile. The inner slices
+    cover all rows without overlapping, the outer slices extend them by
+    overlap rows on both sides as far as possible.
+    """
+    tiles = []
+    for start in range(0, rows, tile_rows):
+        end = min(start + tile_rows, rows)
+        outer = slice(max(start - overlap, 0), min(end + overlap, rows))
+        tiles.append((outer, slice(start, end)))
+    return tiles
+
+
+def unique_values(arr, tiles, null=NULL_CHANGE):
+    """Returns the sorted unique values of arr which are not null"""
+    tile_values = [np.unique(arr[inner][arr[inner] != null]) for _outer, inner in tiles]
+    return np.unique(np.concatenate(tile_values))
+
+
+@numba.njit(cache=True)
+def window_mode(arr, hist, row_start, row_end, col_start, col_end):
+    """Returns the mode and its count in a window of arr from hist
+
+    Scans hist if it is not larger than the window, else the window cells.
+    Ties are resolved to the smallest index, -1 is returned for an empty
+    window.
+    """
+    mode = -1
+    max_count = 0
+    if len(hist) <= (row_end - row_start) * (col_end - col_start):
+        for cat in range(len(hist)):
+            if hist[cat] > max_count:
+                max_count = hist[cat]
+                mode = cat
+        return mode, max_count
+    for win_row in range(row_start, row_end):
+        for win_col in range(col_start, col_end):
+            cat = arr[win_row, win_col]
+            if cat >= 0 and (
+                hist[cat] > max_count or (hist[cat] == max_count and cat < mode)
+            ):
+                max_count = hist[cat]
+                mode = cat
+    return mode, max_count
+
+
+@numba.njit(parallel=True, cache=True)
+def mode_filter(arr, window_size, n_cats):
+    """Applies a mode filter of window_size to arr
+
+    arr holds category indices from 0 to n_cats - 1 and -1 for null.
+    Null cells are ignored, ties are resolved to the smallest index as in
+    r.neighbors and cells without any valid neighbour are null. The
+    histogram and its mode are updated column by column while the window
+    slides along a row, which costs O(window_size) per cell. Only when a
+    cell of the current mode leaves the window, the mode is searched again
+    in O(min(n_cats, window_size**2)).
+    """
+    rows, cols = arr.shape
+    half = window_size // 2
+    out = np.empty_like(arr)
+    for row in numba.prange(rows):
+        hist = np.zeros(n_cats, dtype=np.int32)
+        row_start = max(row - half, 0)
+        row_end = min(row + half + 1, rows)
+        for col in range(min(half, cols - 1) + 1):
+            for win_row in range(row_start, row_end):
+                if arr[win_row, col] >= 0:
+                    hist[arr[win_row, col]] += 1
+        mode, max_count = window_mode(
+            arr, hist, row_start, row_end, 0, min(half + 1, cols)
+        )
+        for col in range(1, cols + 1):
+            out[row, col - 1] = mode
+            if col == cols:
+                break
+            col_add = col + half
+            col_remove = col - half - 1
+            rescan = False
+            if col_remove >= 0:
+                for win_row in range(row_start, row_end):
+                    cat = arr[win_row, col_remove]
+                    if cat >= 0:
+                        hist[cat] -= 1
+                        rescan = rescan or cat == mode
+            if col_add < cols:
+                for win_row in range(row_start, row_end):
+                    cat = arr[win_row, col_add]
+                    if cat >= 0:
+                        hist[cat] += 1
+                        if not rescan and (
+                            hist[cat] > max_count
+                            or (hist[cat] == max_count and cat < mode)
+                        ):
+                            max_count = hist[cat]
+                            mode = cat
+            if rescan:
+                mode, max_count = window_mode(
+                    arr,
+                    hist,
+                    row_start,
+                    row_end,
+                    max(col - half, 0),
+                    min(col + half + 1, cols),
+                )
+    return out
+
+
+def compute_change(map1, map2, all_cats, new_cats, tiles):
+    """Computes the change array from map1 to map2 in a single pass
+
+    The categories of both input arrays are translated to new_cats by a
+    binary search in the sorted categories, so the memory needed does not
+    depend on the range of the category values. Unchanged cells get the
+    value 0, changed cells the value
+    new_cat(map 1) | new_cat(map 2) << CHANGE_BITS. Cells which are null in
+    either map are set to NULL_CHANGE. The maps are processed tile by tile.
+    """
+    cats = np.array([int(cat) for cat in all_cats], dtype=np.int64)
+    order = np.argsort(cats)
+    cats = cats[order]
+    new_cats = np.asarray(new_cats, dtype=np.uint32)[order]
+    change = temp_array(dtype=np.uint32)
+    for _outer, inner in tiles:
+        tile1 = map1[inner]
+        tile2 = map2[inner]
+        # values which are not listed in all_cats, including null, become 0
+        idx1 = np.clip(np.searchsorted(cats, tile1), 0, cats.size - 1)
+        idx2 = np.clip(np.searchsorted(cats, tile2), 0, cats.size - 1)
+        recl1 = np.where(cats[idx1] == tile1, new_cats[idx1], 0)
+        recl2 = np.where(cats[idx2] == tile2, new_cats[idx2], 0)
+        tile = np.where(tile1 == tile2, 0, recl1 | (recl2 << CHANGE_BITS))
+        tile[(recl1 == 0) | (recl2 == 0)] = NULL_CHANGE
+        change[inner] = tile
+    return change
+
+
+def filter_tile(change, filtered, cats_cd, window_size, outer, inner):
+    """Applies the mode filter to one tile of change and stores it in filtered
+
+    The change values are filtered as indices of the sorted cats_cd.
+    """
+    if len(cats_cd) == 0:
+        filtered[inner] = NULL_CHANGE
+        return
+    tile = change[outer]
+    # use the smallest integer type holding all indices and -1 for null
+    idx_type = np.min_scalar_type(-len(cats_cd) - 1)
+    cat_idx = np.searchsorted(cats_cd, tile).astype(idx_type)
+    cat_idx[tile == NULL_CHANGE] = -1
+    tile_idx = mode_filter(cat_idx, window_size, len(cats_cd))
+    # remove the overlap
+    start = inner.start - outer.start
+    stop = inner.stop - outer.start
+    tile_idx = tile_idx[start:stop]
+    filtered[inner] = np.where(tile_idx >= 0, cats_cd[tile_idx], NULL_CHANGE)
+
+
+def filter_change(change, cats_cd, window_size, tiles, nprocs):
+    """Applies a mode filter of window_size to the change array
+
+    The outer slices of the tiles must overlap by at least half the window.
+    The rows of each tile are filtered by nprocs numba threads.
+    """
+    numba.set_num_threads(min(nprocs, numba.config.NUMBA_NUM_THREADS))
+    filtered = temp_array(dtype=np.uint32)
+    for outer, inner in tiles:
+        filter_tile(change, filtered, cats_cd, window_size, outer, inner)
+    return filtered
+
+
+def write_reclassified(arr, values_in, values_out, output, tiles):
+    """Writes arr with the sorted values_in replaced by values_out to output"""
+    values_out = np.asarray(values_out)
+    out = temp_array()
+    if len(values_in) == 0:
+        # no valid values, the output is null only
+        out[:] = -1
+        out.write(output, null=-1, quiet=True)
+        return
+    for _outer, inner in tiles:
+        idx = np.clip(np.searchsorted(values_in, arr[inner]), 0, len(values_in) - 1)
+        out[inner] = np.where(arr[inner] != NULL_CHANGE, values_out[idx], -1)
+    out.write(output, null=-1, quiet=True)
 
 
 def main():
 
-    global rm_rasters
-
     # parameters
     input = options["input"].split(",")
     if len(input) != 2:
         grass.fatal(_("Input must consist of two raster maps"))
     output = options["output"]
     labels = flags["l"]
+    if flags["f"]:
+        if not options["window_size"]:
+            grass.fatal(_("The -f flag requires window_size"))
+        window_size = int(options["window_size"])
+        if window_size < 1 or window_size % 2 == 0:
+            grass.fatal(_("window_size must be a positive odd number"))
+        nprocs = int(options["nprocs"])
+        if nprocs <= 0:
+            nprocs = max(os.cpu_count() + nprocs, 1)
     if options["ignore_value"]:
         str_val = str(options["ignore_value"])
         ignore_label = None
         ignore_val_exists = False
 
-    # get the category values and labels of the input maps
-    cats_in1_tmp = list(
-        grass.parse_command("r.category", map=input[0], separator="tab").keys()
-    )
-    cats_in1 = [cat.split("\t")[0] for cat in cats_in1_tmp]
-    cats_in2_tmp = list(
-        grass.parse_command("r.category", map=input[1], separator="tab").keys()
+    # process the region in tiles of rows fitting into memory
+    region = grass.region()
+    tile_rows = max(
+        int(options["memory"]) * 1024**2 // (region["cols"] * BYTES_PER_CELL), 1
     )
-    cats_in2 = [cat.split("\t")[0] for cat in cats_in2_tmp]
+    tiles = generate_tiling_grid(region["rows"], tile_rows)
+
+    # read the input maps, changes are detected by integer comparison
+    for inmap in input:
+        if grass.raster_info(inmap)["datatype"] != "CELL":
+            grass.warning(
+                _(
+                    "Input map <%s> is not of type CELL, its values are "
+                    "truncated to integers and raster categories are used "
+                    "for result raster labels" % inmap
+                )
+            )
+            # r.category does not list the cell values of floating point maps
+            labels = False
+    map1 = temp_array(input[0], null=NULL_CELL)
+    map2 = temp_array(input[1], null=NULL_CELL)
+
+    # get the category values and labels of the input maps, the values alone
+    # and those of non-CELL maps are taken from the input arrays without an
+    # r.category run
+    if labels:
+        # strip the tab following categories without label
+        cats_in1_tmp = [
+            line.strip()
+            for line in grass.read_command(
+                "r.category", map=input[0], separator="tab"
+            ).splitlines()
+        ]
+        cats_in1 = [cat.split("\t")[0] for cat in cats_in1_tmp]
+        cats_in2_tmp = [
+            line.strip()
+            for line in grass.read_command(
+                "r.category", map=input[1], separator="tab"
+            ).splitlines()
+        ]
+        cats_in2 = [cat.split("\t")[0] for cat in cats_in2_tmp]
+    else:
+        cats_in1 = [str(cat) for cat in unique_values(map1, tiles, NULL_CELL)]
+        cats_in2 = [str(cat) for cat in unique_values(map2, tiles, NULL_CELL)]
     if options["ignore_value"]:
         if str_val in cats_in1 or str_val in cats_in2:
             ignore_val_exists = True
@@ -193,136 +452,86 @@ def main():
             )
             labels = False
 
-    # get unique category values only
-    all_cats = list(set(cats_in1 + cats_in2))
-    all_cats.sort()
+    # get unique category values only, they are sorted as strings which
+    # determines the numbering of the output categories
+    all_cats = sorted({*cats_in1, *cats_in2})
 
     # assign new category values
+    if not all_cats:
+        grass.fatal(_("Input maps contain only null cells in the current region"))
+    if len(all_cats) > CHANGE_MASK:
+        grass.fatal(_("Input maps must not have more than %d categories" % CHANGE_MASK))
     new_cats = np.arange(1, len(all_cats) + 1, 1)
-    new_cats_t1000 = [str(1000 * int(item)) for item in new_cats]
 
     # get new value to ignore
     if options["ignore_value"] and ignore_val_exists is True:
         ignore_idx = all_cats.index(str_val)
         new_ignore_val = new_cats[ignore_idx]
 
-    # reclassify
-    map1_recl = "map1_out_%s" % (os.getpid())
-    map2_recl = "map2_out_%s" % (os.getpid())
-    reclassify(input[0], map1_recl, all_cats, new_cats)
-    reclassify(input[1], map2_recl, all_cats, new_cats_t1000)
-
-    rm_rasters.append(map1_recl)
-    rm_rasters.append(map2_recl)
-
     # calculate change detection map
-    out_tmpname = "%s_%s" % (output, str(os.getpid()))
-    rm_rasters.append(out_tmpname)
-    grass.run_command(
-        "r.mapcalc",
-        expression="%s = if( abs(%s - %s) < %01.16f, 0, %s + %s)"
-        % (out_tmpname, input[0], input[1], GRASS_EPSILON, map1_recl, map2_recl),
-        quiet=True,
-    )
+    change = compute_change(map1, map2, all_cats, new_cats, tiles)
+    cats_cd = unique_values(change, tiles)
+    if len(cats_cd) == 0:
+        grass.fatal(
+            _("Input maps do not overlap with non-null cells in the current region")
+        )
     # filter
-    out_tmpname2 = "%s_temp2_%s" % (output, str(os.getpid()))
     if flags["f"]:
-        window_size = int(options["window_size"])
-        grass.run_command(
-            "r.neighbors",
-            input=out_tmpname,
-            output=out_tmpname2,
-            size=window_size,
-            method="mode",
-            quiet=True,
-        )
-    else:
-        grass.run_command(
-            "g.rename", raster="%s,%s" % (out_tmpname, out_tmpname2), quiet=True
+        filter_tiles = generate_tiling_grid(
+            region["rows"], tile_rows, overlap=(window_size - 1) // 2
         )
+        change = filter_change(change, cats_cd, window_size, filter_tiles, nprocs)
 
-    # get category values of change detection raster
-    cats_cd_tmp = list(
-        grass.parse_command("r.category", map=out_tmpname2, separator="tab").keys()
-    )
-
-    # put together rule string to label change detection map
-    cd_labels = ["0:No Change"]
+    # label all values of the unfiltered change detection map, the mode
+    # filter only removes values
+    new_to_old = {int(new_cat): all_cats[idx] for idx, new_cat in enumerate(new_cats)}
+    if labels:
+        label_by_cat = dict(labellist)
+    cd_labels = {0: "No Change"}
     cats_to_ignore = []
-    for item in cats_cd_tmp:
-        if item != "0":
-            changed_from_reclass = int(item) % 1000
-            changed_to_reclass = int((int(item) - changed_from_reclass) / 1000)
+    for item in cats_cd.tolist():
+        if item != 0:
+            changed_from_reclass = item & CHANGE_MASK
+            changed_to_reclass = item >> CHANGE_BITS
             if options["ignore_value"] and ignore_val_exists is True:
                 if changed_from_reclass == int(
                     new_ignore_val
                 ) or changed_to_reclass == int(new_ignore_val):
                     cats_to_ignore.append(item)
-            changed_from = all_cats[
-                [item for item in new_cats].index(changed_from_reclass)
-            ]
-            changed_to = all_cats[
-                [item for item in new_cats].index(changed_to_reclass)
-            ]
+            changed_from = new_to_old[changed_from_reclass]
+            changed_to = new_to_old[changed_to_reclass]
             if labels:
-                labellist_classnum = [tuple[0] for tuple in labellist]
-                labellist_classtext = [tuple[1] for tuple in labellist]
-                changed_from_label = labellist_classtext[
-                    labellist_classnum.index(changed_from)
-                ]
-                changed_to_label = labellist_classtext[
-                    labellist_classnum.index(changed_to)
-                ]
-                changed_from = changed_from_label
-                changed_to = changed_to_label
-            cd_labels.append(
-                "%s:Change from %s to %s" % (item, changed_from, changed_to)
-            )
-    category_text = "\n".join(cd_labels)
-
-    # assign labels
-    cat_proc = grass.feed_command(
-        "r.category", map=out_tmpname2, rules="-", separator=":"
-    )
-    cat_proc.stdin.write(category_text.encode())
-    cat_proc.stdin.close()
-    # feed_command does not wait until finished
-    cat_proc.wait()
-
-    # get old values to be reclassified to small pixel values
-    old_vals_labels = list(
-        grass.parse_command("r.category", map=out_tmpname2, separator=":").keys()
-    )
-    old_vals = [str.split(":")[0] for str in old_vals_labels]
-    old_labels = [str.split(":")[1] for str in old_vals_labels]
-    out_vals = range(len(old_vals_labels))
-    out_vals_labels = []
-    for idx, out_val in enumerate(out_vals):
-        out_vals_labels.append("%s  %s" % (out_val, old_labels[idx]))
-
-    # create reclassified map
-    reclassmap = "tmp_reclass_%s" % (str(os.getpid()))
-    rm_rasters.append(reclassmap)
-    # add out_tmpname2 after reclassmap, because it is a basemap
-    rm_rasters.append(out_tmpname2)
+                changed_from = label_by_cat[changed_from]
+                changed_to = label_by_cat[changed_to]
+            cd_labels[item] = "Change from %s to %s" % (changed_from, changed_to)
 
+    # get old values to be reclassified to small pixel values, the mode
+    # filter may have removed some of them
+    if flags["f"]:
+        cats_cd = unique_values(change, tiles)
+    out_vals = np.arange(len(cats_cd))
+    out_labels = np.array([cd_labels[item] for item in cats_cd.tolist()], dtype=object)
     if options["ignore_value"] and ignore_val_exists is True:
-        old_vals_ignore_idcs = [old_vals.index(cat) for cat in cats_to_ignore]
-        ignore_out_cat = max(out_vals) + 10
-        for index in old_vals_ignore_idcs:
-            out_vals_labels[index] = "%d areas ignored" % ignore_out_cat
-            if ignore_label:
-                out_vals_labels[index] += " (%s)" % ignore_label
-
-    reclassify(out_tmpname2, reclassmap, old_vals, out_vals_labels)
-    # make reclassified map persistent
-    grass.run_command("r.mapcalc", expression="%s = %s" % (output, reclassmap))
+        ignore_mask = np.isin(cats_cd, cats_to_ignore)
+        ignore_out_cat = out_vals.max() + 10
+        out_vals[ignore_mask] = ignore_out_cat
+        out_labels[ignore_mask] = "areas ignored"
+        if ignore_label:
+            out_labels[ignore_mask] += " (%s)" % ignore_label
+    out_vals_labels = [
+        "%s:%s" % (out_val, label) for out_val, label in zip(out_vals, out_labels)
+    ]
+
+    # write reclassified values directly to the output map
+    write_reclassified(change, cats_cd, out_vals, output, tiles)
+    grass.raster_history(output)
+    feed_rules("r.category", out_vals_labels, map=output, separator=":")
 
     # assign random colors to output map
     grass.run_command("r.colors", map=output, color="random", quiet=True)
 
     # visualise no change in grey, ignored areas in white
-    colors_tmp = list(grass.parse_command("r.colors.out", map=output).keys())
+    colors_tmp = grass.read_command("r.colors.out", map=output).splitlines()
     # r.colors.out does not show color for category 0
     colors_new = ["0 200:200:200"]
     for color_rule in colors_tmp:
@@ -330,35 +539,26 @@ def main():
             if color_rule.split(" ")[0] == str(ignore_out_cat):
                 color_rule = "%s 250:250:250" % str(ignore_out_cat)
         colors_new.append(color_rule)
-    color_str = "\n".join(colors_new)
-    col_proc = grass.feed_command("r.colors", map=output, rules="-", quiet=True)
-    col_proc.stdin.write(color_str.encode())
-    col_proc.stdin.close()
-    col_proc.wait()
+    feed_rules("r.colors", colors_new, map=output, quiet=True)
 
     # calculate statistics and export .csv
     headerline = ["raster value|label|percentage of covered area"]
     if flags["c"]:
         kwargs = {"input": output, "separator": "pipe", "flags": "lp"}
+        # write the header line and let r.stats append its output directly
         if options["csv_path"] and options["csv_path"] != "-":
-            kwargs["output"] = options["csv_path"]
-            grass.run_command("r.stats", **kwargs, quiet=True)
+            with open(options["csv_path"], "w") as outfile:
+                outfile.write("%s\n" % headerline[0])
+                outfile.flush()
+                grass.run_command("r.stats", **kwargs, stdout=outfile, quiet=True)
         else:
-            # print header to stdout too
-            outstr = grass.read_command("r.stats", **kwargs, quiet=True)
-            print("%s\n%s" % (headerline[0], outstr))
+            print(headerline[0])
+            sys.stdout.flush()
+            grass.run_command("r.stats", **kwargs, quiet=True)
 
     grass.message(_("Generated output map <%s>" % (output)))
     if options["csv_path"] and options["csv_path"] != "-":
-        # add header line
         csvfile = options["csv_path"]
-        with open(csvfile, "r") as infile:
-            reader = list(csv.reader(infile))
-            reader.insert(0, headerline)
-        with open(csvfile, "w") as outfile:
-            writer = csv.writer(outfile, lineterminator="\n")
-            for line in reader:
-                writer.writerow(line)
         grass.message(_("Change statistics written to file <%s>" % (csvfile)))
 
 
@@ -34,6 +34,9 @@ class TestRChangeStats(TestCase):
     pid_str = str(os.getpid())
     landuse_map1 = "landuse96_28m_subset"
     landuse_map2 = "landuse96_28m_subset_flipped_%s" % pid_str
+    landuse_map1_float = "landuse96_28m_subset_float_%s" % pid_str
+    many_cats_map1 = "many_cats_%s" % pid_str
+    many_cats_map2 = "many_cats_shifted_%s" % pid_str
     result_cd = "landuse96_28m_subset_CD_%s" % pid_str
     reference_cd = "landuse96_28m_subset_CD_REF"
     reference_stats_file = "data/ref.csv"
@@ -49,12 +52,34 @@ class TestRChangeStats(TestCase):
         self.runModule("g.extension", extension="r.flip")
         self.runModule("r.flip", input=self.landuse_map1, output=self.landuse_map2)
         self.runModule("r.category", map=self.landuse_map2, raster=self.landuse_map1)
+        self.runModule(
+            "r.mapcalc",
+            expression="%s = float(%s)" % (self.landuse_map1_float, self.landuse_map1),
+        )
+        self.runModule(
+            "r.mapcalc", expression="%s = row() * col() %% 1500" % self.many_cats_map1
+        )
+        self.runModule(
+            "r.mapcalc",
+            expression="%s = %s[0,1]" % (self.many_cats_map2, self.many_cats_map1),
+        )
 
     @classmethod
     def tearDownClass(self):
         """Remove the temporary region and generated data"""
         self.del_temp_region()
-        self.runModule("g.remove", type="raster", name=self.landuse_map2, flags="f")
+        self.runModule(
+            "g.remove",
+            type="raster",
+            name="%s,%s,%s,%s"
+            % (
+                self.landuse_map2,
+                self.landuse_map1_float,
+                self.many_cats_map1,
+                self.many_cats_map2,
+            ),
+            flags="f",
+        )
 
     def tearDown(self):
         """Remove the outputs created
@@ -81,6 +106,80 @@ class TestRChangeStats(TestCase):
             self.result_cd, self.reference_cd, precision=0.0
         )
 
+    def test_changedetection_tiled_parallel_equals_reference(self):
+        """Test if change detection raster computed in several tiles and with
+        several threads equals reference"""
+
+        r_change_stats_tiled = SimpleModule(
+            "r.change.stats",
+            input="%s,%s" % (self.landuse_map1, self.landuse_map2),
+            output=self.result_cd,
+            window_size=3,
+            memory=1,
+            nprocs=2,
+            flags="f",
+        )
+        self.assertModule(r_change_stats_tiled)
+        self.assertRasterExists(self.result_cd)
+        # test that the result is the same as reference
+        self.assertRastersNoDifference(
+            self.result_cd, self.reference_cd, precision=0.0
+        )
+
+    def test_changedetection_float_equals_reference(self):
+        """Test if change detection raster of a FCELL input equals reference"""
+
+        r_change_stats_float = SimpleModule(
+            "r.change.stats",
+            input="%s,%s" % (self.landuse_map1_float, self.landuse_map2),
+            output=self.result_cd,
+            window_size=3,
+            csv_path=self.output_stats_file,
+            flags="fcl",
+        )
+        self.assertModule(r_change_stats_float)
+        self.assertRasterExists(self.result_cd)
+        # test that the result is the same as reference
+        self.assertRastersNoDifference(
+            self.result_cd, self.reference_cd, precision=0.0
+        )
+
+    def test_changedetection_many_categories(self):
+        """Test if the change labels of inputs with many categories match the
+        input values"""
+
+        r_change_stats_many = SimpleModule(
+            "r.change.stats",
+            input="%s,%s" % (self.many_cats_map1, self.many_cats_map2),
+            output=self.result_cd,
+        )
+        self.assertModule(r_change_stats_many)
+        self.assertRasterExists(self.result_cd)
+        labels = dict(
+            line.split("\t", 1)
+            for line in gscript.read_command(
+                "r.category", map=self.result_cd
+            ).splitlines()
+        )
+        stats = gscript.read_command(
+            "r.stats",
+            input="%s,%s,%s"
+            % (self.many_cats_map1, self.many_cats_map2, self.result_cd),
+            flags="n",
+        ).splitlines()
+        values_from = set()
+        for line in stats:
+            value_from, value_to, value_cd = line.split()
+            values_from.add(value_from)
+            if value_from == value_to:
+                self.assertEqual(labels[value_cd], "No Change")
+            else:
+                self.assertEqual(
+                    labels[value_cd],
+                    "Change from %s to %s" % (value_from, value_to),
+                )
+        self.assertGreaterEqual(len(values_from), 1000)
+
     def test_changedetection_stats_equal_reference(self):
         """Test if change detection stats equals reference"""
 